@@ -1,8 +1,54 @@
 import streamlit as st
 import pandas as pd
 import google.generativeai as genai
+from google.generativeai import client as genai_client
+import io
 import os
-from estimator import construct_prompt, validate_and_clean_df
+import threading
+from estimator import (
+    build_index, construct_prompt, estimate_batch, read_historical_file,
+    stories_from_df, validate_and_clean_df
+)
+
+
+@st.cache_data(show_spinner=False)
+def _load_validated(file_bytes: bytes, file_name: str):
+    """Parse and validate the uploaded file once and reuse it across reruns."""
+    return validate_and_clean_df(read_historical_file(io.BytesIO(file_bytes), file_name))
+
+
+@st.cache_resource(show_spinner=False)
+def _load_index(file_bytes: bytes, file_name: str):
+    """
+    Build the similarity index once per uploaded file.
+    
+    build_index returns None instead of raising when the index can't be built,
+    so the fallback is cached too and reruns don't retry the model download.
+    """
+    return build_index(_load_validated(file_bytes, file_name))
+
+
+@st.cache_resource(show_spinner=False)
+def _genai_lock():
+    """Process-wide lock around genai's global configuration (shared across sessions)."""
+    return threading.Lock()
+
+
+@st.cache_resource(show_spinner=False)
+def _get_model(api_key: str, model_name: str):
+    """
+    Create a Gemini model bound to this API key, once per key and model name.
+    
+    genai.configure sets process-wide state and GenerativeModel normally builds
+    its client lazily from it on first request, so the client is created
+    eagerly under a lock; a cached model can then never use another key.
+    """
+    with _genai_lock():
+        genai.configure(api_key=api_key)
+        model = genai.GenerativeModel(model_name)
+        model._client = genai_client.get_default_generative_client()
+    return model
+
 
 # Page Config
 st.set_page_config(page_title="AI Story Point Estimator", page_icon="🔢")
@@ -19,24 +65,30 @@ with st.sidebar:
     model_name = st.selectbox("Select Model", ["gemini-1.5-flash", "gemini-2.5-flash", "gemini-1.5-pro", "gemini-pro", "gemini-1.0-pro"])
     
     # Data Source - File Upload Only
-    uploaded_file = st.file_uploader("Upload Historical Data (CSV)", type="csv")
+    uploaded_file = st.file_uploader("Upload Historical Data (CSV or Parquet)", type=["csv", "parquet"])
     
     historical_df = None
+    index = None
     if uploaded_file is not None:
         try:
-            raw_df = pd.read_csv(uploaded_file)
-            historical_df = validate_and_clean_df(raw_df)
+            historical_df = _load_validated(uploaded_file.getvalue(), uploaded_file.name)
             
             if historical_df is not None and not historical_df.empty:
                 st.success(f"✅ Loaded and validated {len(historical_df)} stories")
                 st.info(f"📊 Story points range: {historical_df['StoryPoints'].min():.0f} - {historical_df['StoryPoints'].max():.0f}")
+
+                # Similarity search is optional; fall back to the first examples if unavailable
+                with st.spinner("Building similarity index..."):
+                    index = _load_index(uploaded_file.getvalue(), uploaded_file.name)
+                if index is None:
+                    st.warning("⚠️ Similar story retrieval unavailable, using the first stories as examples.")
             else:
-                st.error("❌ CSV validation failed. Please check the format.")
+                st.error("❌ Data validation failed. Please check the format.")
                 st.info("Required columns: Summary, Description, AcceptanceCriteria, StoryPoints")
         except Exception as e:
-            st.error(f"Error loading CSV: {e}")
+            st.error(f"Error loading file: {e}")
     else:
-        st.info("Please upload a CSV file with historical story points.")
+        st.info("Please upload a CSV or Parquet file with historical story points.")
 
     st.markdown("---")
     with st.expander("ℹ️ How it Works"):
@@ -70,9 +122,6 @@ if st.button("Estimate Story Points", type="primary"):
     else:
         with st.spinner("Analyzing and Estimating..."):
             try:
-                # Configure Gemini
-                genai.configure(api_key=api_key)
-                
                 # Prepare Data
                 new_story = {
                     'summary': summary,
@@ -83,19 +132,51 @@ if st.button("Estimate Story Points", type="primary"):
                 # Construct Prompt
                 # We need to ensure construct_prompt can handle the DF directly or we adapt it.
                 # The existing construct_prompt takes a DF.
-                prompt = construct_prompt(new_story, historical_df)
+                prompt = construct_prompt(new_story, historical_df, index)
                 
                 # Call API
-                model = genai.GenerativeModel(model_name)
-                response = model.generate_content(prompt)
+                model = _get_model(api_key, model_name)
+                response = model.generate_content(prompt, stream=True)
                 
-                # Display Result
+                # Display Result as it streams in
                 st.markdown("### 🤖 Estimation Result")
-                st.markdown(response.text)
+                st.write_stream(chunk.text for chunk in response)
                 
             except Exception as e:
                 st.error(f"An error occurred: {e}")
 
+# Batch Estimation
+st.markdown("---")
+st.header("Batch Estimation")
+st.markdown("Upload a CSV of new stories (Summary, Description, AcceptanceCriteria) to estimate them all at once.")
+
+stories_file = st.file_uploader("Upload New Stories (CSV)", type="csv")
+
+if st.button("Estimate All Stories"):
+    if not api_key:
+        st.error("Please provide a Gemini API Key in the sidebar.")
+    elif historical_df is None:
+        st.error("Please load historical data.")
+    elif stories_file is None:
+        st.error("Please upload a CSV of new stories.")
+    else:
+        try:
+            stories = stories_from_df(pd.read_csv(stories_file))
+            if not stories:
+                st.error("No stories found. The CSV needs a Summary column with at least one value.")
+            else:
+                with st.spinner(f"Estimating {len(stories)} stories..."):
+                    model = _get_model(api_key, model_name)
+                    results = estimate_batch(stories, historical_df, model, index)
+
+                st.markdown("### 🤖 Batch Estimation Results")
+                for story, result in zip(stories, results):
+                    with st.expander(story['summary']):
+                        st.markdown(result)
+
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
+
 # Footer
 st.markdown("---")
 st.caption("Powered by Google Gemini")
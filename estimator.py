@@ -1,10 +1,12 @@
 import os
 import re
 import logging
-from typing import Dict, Optional
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 
+import numpy as np
 import pandas as pd
-import google.generativeai as genai
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -12,10 +14,95 @@ logger = logging.getLogger(__name__)
 
 # Configuration
 DEFAULT_MODEL = "gemini-1.5-flash"
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+NUM_EXAMPLES = 5
+MAX_CONCURRENT_REQUESTS = 8
+
+# Similarity index settings; corpora above IVF_THRESHOLD use IVF-PQ, smaller
+# ones use an 8-bit scalar-quantized flat index
+IVF_THRESHOLD = 100_000
+IVF_NLIST = 256
+IVF_NPROBE = 16
+PQ_M = 16
 FIBONACCI = [1, 2, 3, 5, 8, 13, 21]
 
+# Fibonacci lookup arrays; a value maps to the nearest Fibonacci number by
+# finding which midpoint interval it falls into (ties round down).
+FIB_ARR = np.array(FIBONACCI)
+MIDPOINTS = (FIB_ARR[:-1] + FIB_ARR[1:]) / 2
+
+# Columns every historical data file must provide
+REQUIRED_COLUMNS = ['Summary', 'Description', 'AcceptanceCriteria', 'StoryPoints']
+TEXT_COLUMNS = ['Summary', 'Description', 'AcceptanceCriteria']
+
+# Read text columns as Arrow-backed strings instead of generic object columns;
+# StoryPoints is left to validation so malformed values can be dropped
+CSV_DTYPES = {col: 'string[pyarrow]' for col in TEXT_COLUMNS}
+
+# Common prompt injection patterns, compiled once into a single alternation
+INJECTION_PATTERNS = [
+    r"ignore all previous instructions",
+    r"disregard system prompt",
+    r"you are now",
+    r"ignore these rules",
+    r"forget everything",
+    r"new instructions"
+]
+_INJECTION_RE = re.compile("|".join(f"(?:{p})" for p in INJECTION_PATTERNS), re.IGNORECASE)
+_WS_RE = re.compile(r"\s+")
+
+# Literal substrings, one of which appears in every injection pattern match;
+# used to skip the regex pass for ordinary text
+_INJECTION_PROBES = ("ignore", "disregard", "forget", "instructions", "now", "rules")
+
+# System prompt, built once at import since it only depends on FIBONACCI
+_FIBONACCI_STR = ", ".join(str(f) for f in FIBONACCI)
+_SYSTEM_PROMPT = f"""You are an expert AI Story Point Estimator for agile teams.
 
-def validate_and_clean_df(df: pd.DataFrame) -> Optional[pd.DataFrame]:
+Your task is to estimate story points for new user stories based on historical data and the Fibonacci sequence.
+
+**Rules:**
+1. Story points MUST be one of: [{_FIBONACCI_STR}]
+2. Consider: Uncertainty, Complexity, and Effort
+3. Use historical examples as reference points
+4. Provide clear rationale for your estimate
+5. If uncertain, suggest a range of Fibonacci numbers
+
+**Output Format:**
+- Estimated Story Points: [number]
+- Rationale: [detailed explanation covering uncertainty, complexity, and effort]
+- Confidence: [High/Medium/Low]
+- Similar Stories: [reference to similar historical examples if applicable]
+"""
+
+
+class CleanedHistory(pd.DataFrame):
+    """
+    DataFrame tagged as already validated by validate_and_clean_df.
+    
+    Derived frames (slices, copies) are plain DataFrames, so only the exact
+    object returned by validation carries the tag.
+    """
+    _metadata = ['_validated']
+    _validated = False
+
+
+def nearest_fibonacci(values) -> np.ndarray:
+    """
+    Map values to their nearest Fibonacci number without per-value branching.
+    
+    Args:
+        values: Scalar or array-like of finite numeric story points; NaN and
+            +inf map to the largest Fibonacci number, so filter them first
+        
+    Returns:
+        NumPy scalar for scalar input, otherwise an array of Fibonacci numbers;
+        ties and non-positive values round down
+    """
+    return FIB_ARR[np.searchsorted(MIDPOINTS, values, side='left')]
+
+
+def validate_and_clean_df(df: pd.DataFrame) -> Optional[CleanedHistory]:
     """
     Validate CSV schema, clean missing values, and enforce Fibonacci mapping.
     
@@ -23,7 +110,7 @@ def validate_and_clean_df(df: pd.DataFrame) -> Optional[pd.DataFrame]:
         df: DataFrame to validate and clean
         
     Returns:
-        Cleaned DataFrame or None if validation fails
+        Cleaned DataFrame tagged as CleanedHistory, or None if validation fails
     """
     if df is None:
         logger.error("DataFrame is None")
@@ -33,39 +120,28 @@ def validate_and_clean_df(df: pd.DataFrame) -> Optional[pd.DataFrame]:
     df = df.rename(columns=lambda c: c.strip())
     
     # Check required columns
-    required = ['Summary', 'Description', 'AcceptanceCriteria', 'StoryPoints']
-    if not all(col in df.columns for col in required):
-        logger.error(f"CSV must contain columns: {required}")
+    if not all(col in df.columns for col in REQUIRED_COLUMNS):
+        logger.error(f"CSV must contain columns: {REQUIRED_COLUMNS}")
         return None
 
     # Drop rows with missing critical data
     df = df.dropna(subset=['Summary', 'Description', 'StoryPoints'])
 
-    # Convert StoryPoints to float and handle errors
-    def safe_to_float(x):
-        try:
-            return float(x)
-        except (ValueError, TypeError):
-            return None
-
-    df['StoryPoints'] = df['StoryPoints'].apply(safe_to_float)
-    df = df.dropna(subset=['StoryPoints'])
+    # Convert StoryPoints to float, dropping values that can't be parsed or
+    # aren't finite (e.g. "inf")
+    df['StoryPoints'] = pd.to_numeric(df['StoryPoints'], errors='coerce')
+    df = df[np.isfinite(df['StoryPoints'].to_numpy(dtype=float, na_value=np.nan))]
 
     # Map to nearest Fibonacci number
-    def nearest_fibonacci(val):
-        """Find the nearest Fibonacci number to the given value."""
-        if val <= 0:
-            return FIBONACCI[0]
-        differences = [(abs(val - f), f) for f in FIBONACCI]
-        return min(differences, key=lambda t: t[0])[1]
-
-    df['StoryPoints'] = df['StoryPoints'].apply(nearest_fibonacci)
+    df['StoryPoints'] = nearest_fibonacci(df['StoryPoints'].to_numpy(dtype=float))
 
     # Clean text columns
-    for col in ['Summary', 'Description', 'AcceptanceCriteria']:
-        df[col] = df[col].astype(str).str.strip()
+    for col in TEXT_COLUMNS:
+        df[col] = df[col].astype('string[pyarrow]').str.strip()
 
     logger.info(f"Validated and cleaned {len(df)} historical stories")
+    df = CleanedHistory(df)
+    df._validated = True
     return df
 
 
@@ -83,21 +159,25 @@ def sanitize_text(text: str, max_len: int = 4000) -> str:
     if not isinstance(text, str):
         return ""
 
+    # Only memoize short inputs so the process-wide cache can't pin large texts
+    if len(text) <= 2 * max_len:
+        return _sanitize_str_cached(text, max_len)
+    return _sanitize_str(text, max_len)
+
+
+def _sanitize_str(text: str, max_len: int) -> str:
+    """Body of sanitize_text; only called with str input."""
     # Normalize whitespace
-    text = re.sub(r"\s+", " ", text).strip()
-
-    # Remove common prompt injection patterns
-    injection_patterns = [
-        r"ignore all previous instructions",
-        r"disregard system prompt",
-        r"you are now",
-        r"ignore these rules",
-        r"forget everything",
-        r"new instructions"
-    ]
-    
-    for pattern in injection_patterns:
-        text = re.sub(pattern, "", text, flags=re.IGNORECASE)
+    text = _WS_RE.sub(" ", text).strip()
+
+    # Remove common prompt injection patterns. Non-ASCII text always takes the
+    # regex path since IGNORECASE also matches characters like 'İ' and 'ſ'
+    low = text.lower()
+    if not text.isascii() or any(p in low for p in _INJECTION_PROBES):
+        # Repeat until nothing matches, since removing one phrase can expose another
+        text, n = _INJECTION_RE.subn("", text)
+        while n:
+            text, n = _INJECTION_RE.subn("", text)
 
     # Truncate if too long
     if len(text) > max_len:
@@ -107,12 +187,43 @@ def sanitize_text(text: str, max_len: int = 4000) -> str:
     return text
 
 
+_sanitize_str_cached = functools.lru_cache(maxsize=4096)(_sanitize_str)
+
+
+def read_historical_file(source, filename: str) -> pd.DataFrame:
+    """
+    Read only the required columns of a historical data CSV or Parquet file.
+    
+    Args:
+        source: Path or file-like object containing the data
+        filename: Name of the file, used to detect the format from its extension
+        
+    Returns:
+        Raw DataFrame with typed text columns, ready for validate_and_clean_df
+    """
+    if filename.lower().endswith('.parquet'):
+        return pd.read_parquet(source, columns=REQUIRED_COLUMNS, engine='pyarrow')
+
+    # Read the header first so typed columns still match when names carry
+    # surrounding whitespace (validation strips them afterwards)
+    header = pd.read_csv(source, nrows=0).columns
+    if hasattr(source, 'seek'):
+        source.seek(0)
+
+    return pd.read_csv(
+        source,
+        usecols=[c for c in header if c.strip() in REQUIRED_COLUMNS],
+        dtype={c: CSV_DTYPES[c.strip()] for c in header if c.strip() in CSV_DTYPES},
+        engine='c'
+    )
+
+
 def load_historical_data(filepath: str) -> Optional[pd.DataFrame]:
     """
-    Load and validate historical data from a CSV file.
+    Load and validate historical data from a CSV or Parquet file.
     
     Args:
-        filepath: Path to CSV file
+        filepath: Path to CSV or Parquet file
         
     Returns:
         Validated DataFrame or None if loading fails
@@ -122,20 +233,76 @@ def load_historical_data(filepath: str) -> Optional[pd.DataFrame]:
         return None
     
     try:
-        df = pd.read_csv(filepath)
+        df = read_historical_file(filepath, filepath)
         return validate_and_clean_df(df)
     except Exception as e:
-        logger.error(f"Error reading CSV: {e}")
+        logger.error(f"Error reading historical data: {e}")
+        return None
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoder():
+    """Load the sentence embedding model once per process."""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+
+def _embed(texts) -> np.ndarray:
+    """Encode texts into normalized float32 embeddings for cosine search."""
+    embeddings = _get_encoder().encode(list(texts), normalize_embeddings=True)
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def build_index(historical_df: pd.DataFrame):
+    """
+    Build a semantic-similarity index over historical stories.
+    
+    Args:
+        historical_df: Cleaned DataFrame from validate_and_clean_df
+        
+    Returns:
+        FAISS index whose row ids match historical_df positions, or None if
+        the data is empty or the index can't be built (faiss/sentence-transformers
+        not installed, embedding model download or load failure)
+    """
+    if historical_df is None or historical_df.empty:
+        return None
+
+    try:
+        import faiss
+    except ImportError as e:
+        logger.warning(f"Semantic search unavailable, using first examples instead: {e}")
+        return None
+
+    try:
+        embeddings = _embed(historical_df['Summary'] + ' ' + historical_df['Description'])
+
+        d = embeddings.shape[1]
+        if len(embeddings) > IVF_THRESHOLD:
+            quantizer = faiss.IndexFlatIP(d)
+            index = faiss.IndexIVFPQ(quantizer, d, IVF_NLIST, PQ_M, 8, faiss.METRIC_INNER_PRODUCT)
+            index.nprobe = IVF_NPROBE
+        else:
+            index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        index.train(embeddings)
+        index.add(embeddings)
+    except Exception as e:
+        logger.warning(f"Could not build similarity index, using first examples instead: {e}")
         return None
 
+    logger.info(f"Built similarity index over {index.ntotal} historical stories")
+    return index
+
 
-def construct_prompt(new_story: Dict[str, str], historical_df: pd.DataFrame) -> str:
+def construct_prompt(new_story: Dict[str, str], historical_df: pd.DataFrame, index=None) -> str:
     """
     Construct the prompt for the Gemini model with sanitized inputs.
     
     Args:
         new_story: Dictionary with 'summary', 'description', 'acceptance_criteria'
-        historical_df: DataFrame with historical story data
+        historical_df: DataFrame with historical story data; validated unless it
+            is a CleanedHistory from validate_and_clean_df
+        index: Optional index from build_index used to pick the most similar examples
         
     Returns:
         Formatted prompt string
@@ -145,47 +312,38 @@ def construct_prompt(new_story: Dict[str, str], historical_df: pd.DataFrame) ->
     description = sanitize_text(new_story.get('description', ''))
     acceptance_criteria = sanitize_text(new_story.get('acceptance_criteria', ''))
 
-    # Validate and clean historical data
-    hist_df = validate_and_clean_df(historical_df)
-    
-    if hist_df is None or hist_df.empty:
-        logger.warning("No valid historical data available")
-        examples = []
-    else:
-        # Use first 5 examples (simple approach, can be enhanced with similarity search later)
-        examples = hist_df.head(5).to_dict('records')
-
-    # System prompt
-    fibonacci_str = ", ".join(str(f) for f in FIBONACCI)
-    system_prompt = f"""You are an expert AI Story Point Estimator for agile teams.
-
-Your task is to estimate story points for new user stories based on historical data and the Fibonacci sequence.
-
-**Rules:**
-1. Story points MUST be one of: [{fibonacci_str}]
-2. Consider: Uncertainty, Complexity, and Effort
-3. Use historical examples as reference points
-4. Provide clear rationale for your estimate
-5. If uncertain, suggest a range of Fibonacci numbers
-
-**Output Format:**
-- Estimated Story Points: [number]
-- Rationale: [detailed explanation covering uncertainty, complexity, and effort]
-- Confidence: [High/Medium/Low]
-- Similar Stories: [reference to similar historical examples if applicable]
-"""
+    # Validate raw DataFrames; already-cleaned history is used as-is
+    if historical_df is not None and not (
+        isinstance(historical_df, CleanedHistory) and historical_df._validated
+    ):
+        historical_df = validate_and_clean_df(historical_df)
 
-    # Historical examples
     example_text = ""
-    if examples:
-        example_text = "\n\n### Historical Examples (for reference):\n"
-        for i, ex in enumerate(examples, 1):
-            example_text += f"""
-{i}. Summary: {sanitize_text(ex.get('Summary', ''))}
-   Description: {sanitize_text(ex.get('Description', ''))}
-   Acceptance Criteria: {sanitize_text(ex.get('AcceptanceCriteria', ''))}
-   Story Points: {ex.get('StoryPoints')}
+    if historical_df is None or historical_df.empty:
+        logger.warning("No valid historical data available")
+    else:
+        if index is not None:
+            # Retrieve the most similar historical stories
+            k = min(NUM_EXAMPLES, index.ntotal)
+            _, ids = index.search(_embed([f"{summary} {description}"]), k)
+            examples = historical_df.iloc[ids[0][ids[0] >= 0]][REQUIRED_COLUMNS].copy()
+        else:
+            examples = historical_df.head(NUM_EXAMPLES)[REQUIRED_COLUMNS].copy()
+        for col in TEXT_COLUMNS:
+            examples[col] = examples[col].map(sanitize_text)
+
+        # Historical examples
+        parts = ["\n\n### Historical Examples (for reference):\n"]
+        parts.extend(
+            f"""
+{i}. Summary: {s}
+   Description: {d}
+   Acceptance Criteria: {ac}
+   Story Points: {sp}
 """
+            for i, (s, d, ac, sp) in enumerate(examples.itertuples(index=False, name=None), 1)
+        )
+        example_text = "".join(parts)
 
     # New story to estimate
     new_story_text = f"""
@@ -201,12 +359,69 @@ Your task is to estimate story points for new user stories based on historical d
 Please provide your story point estimate following the rules and format above.
 """
 
-    full_prompt = system_prompt + example_text + new_story_text
+    full_prompt = "".join([_SYSTEM_PROMPT, example_text, new_story_text])
     return full_prompt
 
 
+def stories_from_df(df: pd.DataFrame) -> List[Dict[str, str]]:
+    """
+    Convert a DataFrame of new stories into construct_prompt inputs.
+    
+    Args:
+        df: DataFrame with a 'Summary' column and optional 'Description'
+            and 'AcceptanceCriteria' columns
+        
+    Returns:
+        List of story dictionaries; rows without a summary are skipped
+    """
+    df = df.rename(columns=lambda c: c.strip())
+    if 'Summary' not in df.columns:
+        logger.error("New stories file must contain a 'Summary' column")
+        return []
+
+    df = df.reindex(columns=TEXT_COLUMNS).fillna('').astype(str)
+    return [
+        {'summary': s.strip(), 'description': d.strip(), 'acceptance_criteria': ac.strip()}
+        for s, d, ac in zip(df['Summary'], df['Description'], df['AcceptanceCriteria'])
+        if s.strip()
+    ]
+
+
+def estimate_batch(stories: List[Dict[str, str]], historical_df: pd.DataFrame,
+                   model, index=None) -> List[str]:
+    """
+    Estimate several stories with concurrent Gemini requests.
+    
+    Args:
+        stories: List of dictionaries with 'summary', 'description', 'acceptance_criteria'
+        historical_df: DataFrame with historical story data
+        model: Configured genai.GenerativeModel
+        index: Optional index from build_index used to pick the most similar examples
+        
+    Returns:
+        Estimation text for each story, in input order; failed requests
+        yield an error message instead
+    """
+    prompts = [construct_prompt(story, historical_df, index) for story in stories]
+
+    def _generate(prompt: str) -> str:
+        try:
+            return model.generate_content(prompt).text
+        except Exception as e:
+            logger.error(f"Error calling Gemini API: {e}")
+            return f"Error: {e}"
+
+    # Blocking calls in a thread pool; the SDK's async client is bound to the
+    # event loop it was created on, so it can't be reused across batches
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        return list(executor.map(_generate, prompts))
+
+
 def estimate_story_points():
     """CLI interface for story point estimation (for testing)."""
+    # Imported here so validation and prompt building don't pay for the SDK import
+    import google.generativeai as genai
+
     print("Welcome to the AI Story Point Estimator (Gemini Powered).")
     
     # 1. Get API Key
@@ -218,14 +433,15 @@ def estimate_story_points():
     genai.configure(api_key=api_key)
     
     # 2. Get Historical Data File
-    csv_path = input("Enter path to historical data CSV: ").strip()
-    if not csv_path:
-        print("CSV path is required.")
+    data_path = input("Enter path to historical data (CSV or Parquet): ").strip()
+    if not data_path:
+        print("Data file path is required.")
         return
         
-    historical_df = load_historical_data(csv_path)
+    historical_df = load_historical_data(data_path)
     if historical_df is None:
         return
+    index = build_index(historical_df)
 
     # 3. Get New Story Details
     print("\n--- New Story Details ---")
@@ -244,16 +460,17 @@ def estimate_story_points():
     }
 
     # 4. Generate Content
-    prompt = construct_prompt(new_story, historical_df)
+    prompt = construct_prompt(new_story, historical_df, index)
     
     print("\nAnalyzing and Estimating...")
     
     try:
         model = genai.GenerativeModel(DEFAULT_MODEL)
-        response = model.generate_content(prompt)
+        response = model.generate_content(prompt, stream=True)
+        print("\n" + "="*60)
+        for chunk in response:
+            print(chunk.text, end="", flush=True)
         print("\n" + "="*60)
-        print(response.text)
-        print("="*60)
     except Exception as e:
         logger.error(f"Error calling Gemini API: {e}")
         print(f"Error: {e}")